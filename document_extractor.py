@@ -12,6 +12,13 @@ from typing import Dict, List, Optional, Tuple, Any
 from datetime import datetime
 import requests
 
+# Optional faster JSON decoder for Ollama responses
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 
 class DocumentExtractor:
     """
@@ -224,7 +231,7 @@ class DocumentExtractor:
             )
 
             if response.status_code == 200:
-                result = response.json()
+                result = _json_loads(response.content)
                 output = result.get("response", "")
                 llm_time = time.time() - start_time
                 return output, llm_time, None
@@ -250,15 +257,15 @@ class DocumentExtractor:
             cleaned = cleaned.strip()
 
             # Parse JSON
-            parsed = json.loads(cleaned)
+            parsed = _json_loads(cleaned)
             return parsed
 
-        except json.JSONDecodeError as e:
+        except ValueError as e:
             # Try to extract JSON from text
             json_match = re.search(r'\{[\s\S]*\}', raw_output)
             if json_match:
                 try:
-                    return json.loads(json_match.group(0))
+                    return _json_loads(json_match.group(0))
                 except:
                     pass
             return None
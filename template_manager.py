@@ -9,11 +9,170 @@ This module provides functionality to:
 - Manage template metadata
 """
 
+import ast
+import hashlib
 import json
+from dataclasses import dataclass
+from graphlib import TopologicalSorter, CycleError
 from pathlib import Path
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Set, Tuple
 import re
 
+# Aho-Corasick keyword scanning (optional - falls back to substring checks)
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+# Native edit-distance similarity (optional - falls back to word Jaccard)
+try:
+    from rapidfuzz import fuzz
+    RAPIDFUZZ_AVAILABLE = True
+except ImportError:
+    RAPIDFUZZ_AVAILABLE = False
+
+
+# Max identify_all_test_types results remembered per TemplateManager
+IDENTIFY_CACHE_SIZE = 256
+
+# Node types a template formula may contain (plain arithmetic on parameter IDs)
+_FORMULA_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Load,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.USub, ast.UAdd
+)
+
+# formula string -> (code object, referenced parameter IDs), or None if invalid
+_FORMULA_CACHE: Dict[str, Optional[Tuple]] = {}
+
+
+def compile_formula(formula: str) -> Optional[Tuple]:
+    """Compile a template formula once; returns (code, dependency IDs) or None."""
+    if formula not in _FORMULA_CACHE:
+        compiled = None
+        try:
+            tree = ast.parse(formula, mode="eval")
+            if all(isinstance(node, _FORMULA_NODES) for node in ast.walk(tree)):
+                deps = frozenset(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+                compiled = (compile(tree, "<formula>", "eval"), deps)
+        except SyntaxError:
+            pass
+        _FORMULA_CACHE[formula] = compiled
+    return _FORMULA_CACHE[formula]
+
+
+# Test-type keyword rules: test_type -> ((pattern, score), ...)
+_TEST_TYPE_RULES: Dict[str, Tuple[Tuple[re.Pattern, int], ...]] = {
+    "COMPLETE_BLOOD_COUNT": (
+        (re.compile(r'\b(CBC|COMPLETE BLOOD COUNT|HEMOGRAM)\b'), 15),
+        (re.compile(r'\b(HAEMOGLOBIN|HEMOGLOBIN|WBC|RBC|PLATELET)\b'), 5),
+    ),
+    "DENGUE_PROFILE": ((re.compile(r'\b(DENGUE|NS1|IGG|IGM)\b'), 15),),
+    "LIPID_PROFILE": ((re.compile(r'\b(LIPID|CHOLESTEROL|HDL|LDL|TRIGLYCERIDE)\b'), 15),),
+    "LIVER_FUNCTION_TEST": ((re.compile(r'\b(LFT|LIVER FUNCTION|SGOT|SGPT|ALT|AST|BILIRUBIN|ALKALINE PHOSPHATASE)\b'), 15),),
+    "KIDNEY_FUNCTION_TEST": ((re.compile(r'\b(KFT|RFT|KIDNEY FUNCTION|RENAL FUNCTION|CREATININE|UREA|BUN)\b'), 15),),
+    "THYROID_FUNCTION_TEST": ((re.compile(r'\b(TFT|THYROID|TSH|T3|T4|FT3|FT4)\b'), 15),),
+    "GLUCOSE_PANEL": ((re.compile(r'\b(GLUCOSE|SUGAR|HBA1C|FASTING|POSTPRANDIAL|DIABETES)\b'), 15),),
+    "CRP_TEST": ((re.compile(r'\b(CRP|C.REACTIVE PROTEIN|C REACTIVE|CREACTIVE)\b'), 15),),
+    "ESR_TEST": ((re.compile(r'\b(ESR|ERYTHROCYTE SEDIMENTATION|SEDIMENTATION RATE)\b'), 15),),
+    "COVID19_TEST": ((re.compile(r'\b(COVID|SARS.COV.2|CORONAVIRUS|RT.PCR|ANTIGEN)\b'), 15),),
+    "MALARIA_TEST": ((re.compile(r'\b(MALARIA|PLASMODIUM|FALCIPARUM|VIVAX)\b'), 15),),
+    "TYPHOID_TEST": ((re.compile(r'\b(TYPHOID|WIDAL|TYPHI|PARATYPHI)\b'), 15),),
+    "VITAMIN_D_TEST": ((re.compile(r'\b(VITAMIN D|25.OH|25 HYDROXY|CHOLECALCIFEROL)\b'), 15),),
+    "VITAMIN_B12_TEST": ((re.compile(r'\b(VITAMIN B12|B12|COBALAMIN|CYANOCOBALAMIN)\b'), 15),),
+    "IRON_STUDIES": ((re.compile(r'\b(IRON|FERRITIN|TIBC|TRANSFERRIN|IRON BINDING)\b'), 15),),
+    "ELECTROLYTES_PANEL": ((re.compile(r'\b(ELECTROLYTE|SODIUM|POTASSIUM|CHLORIDE|NA\+|K\+)\b'), 15),),
+    "CARDIAC_ENZYMES": ((re.compile(r'\b(TROPONIN|CPK|CK.MB|CARDIAC|BNP|NT.PROBNP)\b'), 15),),
+    "URINE_ROUTINE": ((re.compile(r'\b(URINE|URINALYSIS|MICROSCOPY|PUS CELLS)\b'), 15),),
+    "COAGULATION_PANEL": ((re.compile(r'\b(COAGULATION|PT|INR|APTT|PROTHROMBIN|BLEEDING TIME)\b'), 15),),
+    "HEPATITIS_PANEL": ((re.compile(r'\b(HEPATITIS|HBSAG|ANTI.HCV|HBV|HCV|HAV)\b'), 15),),
+    # Clinical Documents
+    "PRESCRIPTION": (
+        (re.compile(r'\b(PRESCRIPTION|RX|MEDICATION|DOSAGE|TABLET|CAPSULE|MEDICINE)\b'), 20),
+        (re.compile(r'\b(DOCTOR|DR\.|PHYSICIAN|CONSULTANT|MBBS|MD)\b'), 5),
+        (re.compile(r'\b(FREQUENCY|DURATION|DAYS|TIMES DAILY|BD|TDS|OD)\b'), 5),
+    ),
+    "DISCHARGE_SUMMARY": (
+        (re.compile(r'\b(DISCHARGE|ADMISSION|HOSPITALIZATION|INPATIENT|IPD)\b'), 20),
+        (re.compile(r'\b(ADMITTED|DISCHARGED|LENGTH OF STAY|FINAL DIAGNOSIS)\b'), 5),
+    ),
+    "MEDICAL_CERTIFICATE": (
+        (re.compile(r'\b(MEDICAL CERTIFICATE|SICK LEAVE|FITNESS CERTIFICATE|UNFIT|REST)\b'), 20),
+        (re.compile(r'\b(LEAVE FROM|LEAVE TO|DAYS OF LEAVE)\b'), 5),
+    ),
+    # Financial Documents
+    "HOSPITAL_BILL": (
+        (re.compile(r'\b(BILL|INVOICE|RECEIPT|CHARGES|CONSULTATION FEE|PAYABLE)\b'), 15),
+        (re.compile(r'\b(HOSPITAL|CLINIC|MEDICAL CENTER|HEALTH)\b'), 5),
+        (re.compile(r'\b(SUBTOTAL|TAX|GST|TOTAL AMOUNT|NET AMOUNT)\b'), 5),
+        # Distinguish from pharmacy bill
+        (re.compile(r'\b(ROOM CHARGES|CONSULTATION|PROCEDURE|SURGERY|IPD|OPD)\b'), 5),
+    ),
+    "PHARMACY_BILL": (
+        (re.compile(r'\b(PHARMACY|CHEMIST|MEDICAL STORE|DRUGSTORE)\b'), 20),
+        (re.compile(r'\b(MEDICINE|DRUG|TABLET|CAPSULE|SYRUP|MRP|BATCH)\b'), 5),
+        (re.compile(r'\b(EXPIRY|BATCH NO|DL NO|DRUG LICENSE)\b'), 5),
+    ),
+    # Diagnostic Documents
+    "ECG_REPORT": (
+        (re.compile(r'\b(ECG|EKG|ELECTROCARDIOGRAM|CARDIOGRAM)\b'), 20),
+        (re.compile(r'\b(HEART RATE|RHYTHM|PR INTERVAL|QRS|QT INTERVAL)\b'), 5),
+    ),
+    "XRAY_REPORT": (
+        (re.compile(r'\b(X.RAY|XRAY|RADIOGRAPH|CHEST PA|CHEST X.RAY)\b'), 20),
+        (re.compile(r'\b(FINDINGS|IMPRESSION|RADIOLOGIST|VIEW)\b'), 5),
+    ),
+    "ULTRASOUND_REPORT": (
+        (re.compile(r'\b(ULTRASOUND|USG|SONOGRAPHY|DOPPLER)\b'), 20),
+        (re.compile(r'\b(ABDOMEN|PELVIS|KUB|OBSTETRIC|FINDINGS|IMPRESSION)\b'), 5),
+    ),
+    # Administrative Documents
+    "VACCINATION_CERTIFICATE": (
+        (re.compile(r'\b(VACCINATION|VACCINE|IMMUNIZATION|DOSE|COVAXIN|COVISHIELD)\b'), 20),
+        (re.compile(r'\b(1ST DOSE|2ND DOSE|BOOSTER|BATCH NUMBER)\b'), 5),
+    ),
+}
+
+
+def _rule_anchors(pattern: re.Pattern) -> Optional[frozenset]:
+    """
+    Literal substrings one of which must appear for a rule pattern to match
+    (longest literal run of each alternative), or None if it can't be derived.
+    """
+    source = pattern.pattern
+    if not (source.startswith(r'\b(') and source.endswith(r')\b')):
+        return None
+
+    anchors = set()
+    for alternative in source[3:-3].split("|"):
+        if re.search(r'[\[\]()?*{}^$]|\\[^.+]', alternative):
+            return None
+        # Unescaped "." is a wildcard; escaped "\." and "\+" are literal
+        pieces = [piece.replace("\\", "") for piece in re.split(r'(?<!\\)\.', alternative)]
+        anchor = max(pieces, key=len)
+        if not anchor:
+            return None
+        anchors.add(anchor)
+    return frozenset(anchors)
+
+
+# pattern -> anchors, used to skip rule regexes whose keywords can't be in the text
+_RULE_ANCHORS = {
+    pattern: _rule_anchors(pattern)
+    for patterns in _TEST_TYPE_RULES.values()
+    for pattern, _ in patterns
+}
+
+
+@dataclass
+class CompiledTemplate:
+    """Per-template lookups derived once from the raw template JSON."""
+    template_id: str
+    expected_param_ids: Tuple[str, ...]       # parameterIds in template order
+    section_index: Dict[str, List[Dict]]      # sectionId -> parameters
+    formula_order: List[Tuple]                # (parameterId, sectionId, param, (code, deps)) in dependency order
+    param_limits: Dict[str, Tuple]            # parameterId -> (default reference range, critical low, critical high)
+
 
 class TemplateManager:
     """Manages test templates for medical document extraction."""
@@ -23,6 +182,17 @@ class TemplateManager:
         self.templates_dir = Path(templates_dir)
         self.templates: Dict[str, Dict] = {}
         self.template_index: Dict[str, str] = {}  # Maps test type to template ID
+        self._template_keywords: Dict[str, tuple] = {}  # Template ID -> (display name, aliases, department), uppercased
+        self._keywords: Set[str] = set()
+        self._keyword_automaton = None
+        self._template_test_types: Dict[str, str] = {}
+        self._template_summaries: List[Dict] = []
+        self._template_order: Dict[str, int] = {}
+        self._keyword_templates: Dict[str, Set[str]] = {}
+        self._unfiltered_templates: Set[str] = set()
+        self._param_names: Dict[int, tuple] = {}
+        self._compiled_templates: Dict[str, tuple] = {}  # Template ID -> (template, CompiledTemplate)
+        self._identify_cache: Dict[tuple, tuple] = {}  # (text digest, threshold, top_only) -> ((template ID, score), ...)
         self._load_all_templates()
 
     def _load_all_templates(self):
@@ -53,6 +223,110 @@ class TemplateManager:
             except Exception as e:
                 print(f"❌ Error loading template {template_file.name}: {e}")
 
+        self._build_keyword_index()
+
+    def _build_keyword_index(self):
+        """
+        Precompute uppercased display names, aliases and departments for all
+        templates, and build an Aho-Corasick automaton over them (plus the
+        test-type rule anchors) so keyword detection is a single pass over the OCR text.
+        """
+        self._identify_cache.clear()  # scores depend on the loaded templates
+        self._template_keywords = {}
+        self._template_test_types = {}
+        self._template_summaries = []  # list_templates() rows, in load order
+        self._template_order = {}
+        self._param_names = {}  # id(param) -> (param, (displayName, parameterId, aliases) upper-cased)
+        self._keyword_templates = {}  # keyword/anchor -> templateIds it can score for
+        self._unfiltered_templates = set()  # templates with rules that must always run
+        keywords = set()
+
+        for template_id, template in self.templates.items():
+            display_name = template.get("displayName", "").upper()
+            aliases = tuple(a.upper() for a in template.get("metadata", {}).get("commonAliases", []))
+            department = template.get("department", "").upper()
+
+            self._template_keywords[template_id] = (display_name, aliases, department)
+            self._template_order[template_id] = len(self._template_order)
+            template_keywords = {display_name, department, *aliases}
+
+            test_type = template.get("testType") or template.get("documentType")
+            self._template_test_types[template_id] = test_type
+            self._template_summaries.append({
+                "templateId": template.get("templateId"),
+                "testType": test_type,
+                "displayName": template.get("displayName"),
+                "category": template.get("category") or template.get("department"),
+                "version": template.get("version"),
+                "extractionType": template.get("extractionType", "PARAMETER_BASED")
+            })
+
+            # Rule-pattern anchors share the same pass, so rule regexes only run on candidates
+            for pattern, _ in _TEST_TYPE_RULES.get(test_type, ()):
+                anchors = _RULE_ANCHORS[pattern]
+                if anchors is None:
+                    self._unfiltered_templates.add(template_id)
+                else:
+                    template_keywords.update(anchors)
+
+            for keyword in template_keywords:
+                self._keyword_templates.setdefault(keyword, set()).add(template_id)
+            keywords.update(template_keywords)
+
+            for section in template.get("sections", []):
+                for param in section.get("parameters", []):
+                    self._param_names[id(param)] = (param, self._upper_names(param))
+
+        # Empty keywords (e.g. missing department) always match - handled in _find_keywords
+        keywords.discard("")
+        self._keywords = keywords
+
+        self._keyword_automaton = None
+        if AHOCORASICK_AVAILABLE and keywords:
+            automaton = ahocorasick.Automaton()
+            for keyword in keywords:
+                automaton.add_word(keyword, keyword)
+            automaton.make_automaton()
+            self._keyword_automaton = automaton
+
+    @staticmethod
+    def _upper_names(param: Dict) -> Tuple[str, str, frozenset]:
+        """Uppercase displayName, parameterId and alias set for a template parameter."""
+        return (param.get("displayName", "").upper(),
+                param.get("parameterId", "").upper(),
+                frozenset(alias.upper() for alias in param.get("aliases", [])))
+
+    def _find_keywords(self, ocr_text_upper: str) -> Set[str]:
+        """Return the set of template keywords present in the (uppercased) OCR text."""
+        if self._keyword_automaton is not None:
+            found = {keyword for _, keyword in self._keyword_automaton.iter(ocr_text_upper)}
+        else:
+            found = {keyword for keyword in self._keywords if keyword in ocr_text_upper}
+
+        # An empty string is contained in any text
+        found.add("")
+        return found
+
+    def _keyword_score(self, template_id: str, found_keywords: Set[str]) -> int:
+        """Score display name, alias and department hits for a template."""
+        display_name, aliases, department = self._template_keywords[template_id]
+        score = 0
+
+        # Check display name (strong match)
+        if display_name in found_keywords:
+            score += 10
+
+        # Check aliases (strong match)
+        for alias in aliases:
+            if alias in found_keywords:
+                score += 8
+
+        # Check department (weak match)
+        if department in found_keywords:
+            score += 2
+
+        return score
+
     def get_template(self, template_id: str) -> Optional[Dict]:
         """Get template by template ID."""
         return self.templates.get(template_id)
@@ -64,19 +338,60 @@ class TemplateManager:
             return self.templates.get(template_id)
         return None
 
+    def compile_template(self, template: Dict) -> CompiledTemplate:
+        """Get the cached CompiledTemplate for a template dict (built on first use)."""
+        template_id = template.get("templateId")
+        cached = self._compiled_templates.get(template_id)
+        if cached and cached[0] is template:
+            return cached[1]
+
+        expected_param_ids = []
+        section_index = {}
+        formula_params = {}
+        param_limits = {}
+        for section in template.get("sections", []):
+            section_id = section.get("sectionId")
+            parameters = section.get("parameters", [])
+            section_index[section_id] = parameters
+            for param in parameters:
+                param_id = param.get("parameterId", "")
+                if param_id:
+                    expected_param_ids.append(param_id)
+                    param_limits.setdefault(param_id, self.reference_limits(param))
+                    if param.get("formula"):
+                        formula_params.setdefault(param_id, (section_id, param))
+
+        # Order formulas so ones built on other calculated values come later
+        sorter = TopologicalSorter()
+        for param_id, (_, param) in formula_params.items():
+            compiled = compile_formula(param["formula"])
+            deps = compiled[1] if compiled else ()
+            sorter.add(param_id, *(d for d in deps if d in formula_params and d != param_id))
+        try:
+            order = list(sorter.static_order())
+        except CycleError:
+            order = list(formula_params)
+
+        formula_order = []
+        for param_id in order:
+            section_id, param = formula_params[param_id]
+            compiled = compile_formula(param["formula"])
+            if compiled is not None:
+                formula_order.append((param_id, section_id, param, compiled))
+
+        result = CompiledTemplate(
+            template_id=template_id,
+            expected_param_ids=tuple(expected_param_ids),
+            section_index=section_index,
+            formula_order=formula_order,
+            param_limits=param_limits
+        )
+        self._compiled_templates[template_id] = (template, result)
+        return result
+
     def list_templates(self) -> List[Dict]:
         """List all available templates with basic info."""
-        result = []
-        for template in self.templates.values():
-            result.append({
-                "templateId": template.get("templateId"),
-                "testType": template.get("testType") or template.get("documentType"),
-                "displayName": template.get("displayName"),
-                "category": template.get("category") or template.get("department"),
-                "version": template.get("version"),
-                "extractionType": template.get("extractionType", "PARAMETER_BASED")
-            })
-        return result
+        return [dict(summary) for summary in self._template_summaries]
 
     def identify_test_type(self, ocr_text: str) -> Optional[str]:
         """
@@ -84,363 +399,84 @@ class TemplateManager:
 
         Returns the test_type if found, None otherwise.
         """
-        ocr_text_upper = ocr_text.upper()
-
-        # Check each template for matches
-        best_match = None
-        max_score = 0
-
-        for template in self.templates.values():
-            score = 0
-            test_type = template.get("testType") or template.get("documentType")
-            display_name = template.get("displayName", "").upper()
-            aliases = template.get("metadata", {}).get("commonAliases", [])
-            department = template.get("department", "").upper()
-
-            # Check display name (strong match)
-            if display_name in ocr_text_upper:
-                score += 10
-
-            # Check aliases (strong match)
-            for alias in aliases:
-                if alias.upper() in ocr_text_upper:
-                    score += 8
-
-            # Check department (weak match)
-            if department in ocr_text_upper:
-                score += 2
-
-            # Check for specific test type keywords
-            if test_type == "COMPLETE_BLOOD_COUNT":
-                if re.search(r'\b(CBC|COMPLETE BLOOD COUNT|HEMOGRAM)\b', ocr_text_upper):
-                    score += 15
-                if re.search(r'\b(HAEMOGLOBIN|HEMOGLOBIN|WBC|RBC|PLATELET)\b', ocr_text_upper):
-                    score += 5
-
-            elif test_type == "DENGUE_PROFILE":
-                if re.search(r'\b(DENGUE|NS1|IGG|IGM)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "LIPID_PROFILE":
-                if re.search(r'\b(LIPID|CHOLESTEROL|HDL|LDL|TRIGLYCERIDE)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "LIVER_FUNCTION_TEST":
-                if re.search(r'\b(LFT|LIVER FUNCTION|SGOT|SGPT|ALT|AST|BILIRUBIN)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "KIDNEY_FUNCTION_TEST":
-                if re.search(r'\b(KFT|RFT|KIDNEY FUNCTION|RENAL FUNCTION|CREATININE|UREA)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "THYROID_FUNCTION_TEST":
-                if re.search(r'\b(TFT|THYROID|TSH|T3|T4)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "GLUCOSE_PANEL":
-                if re.search(r'\b(GLUCOSE|HBA1C|FASTING|POSTPRANDIAL)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "CRP_TEST":
-                if re.search(r'\b(CRP|C.REACTIVE PROTEIN)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "ESR_TEST":
-                if re.search(r'\b(ESR|SEDIMENTATION RATE)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "COVID19_TEST":
-                if re.search(r'\b(COVID|SARS.COV.2|RT.PCR)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "MALARIA_TEST":
-                if re.search(r'\b(MALARIA|PLASMODIUM)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "TYPHOID_TEST":
-                if re.search(r'\b(TYPHOID|WIDAL)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "VITAMIN_D_TEST":
-                if re.search(r'\b(VITAMIN D|25.OH)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "VITAMIN_B12_TEST":
-                if re.search(r'\b(VITAMIN B12|B12|COBALAMIN)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "IRON_STUDIES":
-                if re.search(r'\b(IRON|FERRITIN|TIBC)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "ELECTROLYTES_PANEL":
-                if re.search(r'\b(ELECTROLYTE|SODIUM|POTASSIUM)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "CARDIAC_ENZYMES":
-                if re.search(r'\b(TROPONIN|CPK|CK.MB)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "URINE_ROUTINE":
-                if re.search(r'\b(URINE|URINALYSIS|MICROSCOPY)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "COAGULATION_PANEL":
-                if re.search(r'\b(COAGULATION|PT|INR|APTT)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "HEPATITIS_PANEL":
-                if re.search(r'\b(HEPATITIS|HBSAG|ANTI.HCV)\b', ocr_text_upper):
-                    score += 15
-
-            # Clinical Documents
-            elif test_type == "PRESCRIPTION":
-                if re.search(r'\b(PRESCRIPTION|RX|MEDICATION|DOSAGE|TABLET|CAPSULE)\b', ocr_text_upper):
-                    score += 20
-
-            elif test_type == "DISCHARGE_SUMMARY":
-                if re.search(r'\b(DISCHARGE|ADMISSION|HOSPITALIZATION)\b', ocr_text_upper):
-                    score += 20
-
-            elif test_type == "MEDICAL_CERTIFICATE":
-                if re.search(r'\b(MEDICAL CERTIFICATE|SICK LEAVE|FITNESS)\b', ocr_text_upper):
-                    score += 20
-
-            # Financial Documents
-            elif test_type == "HOSPITAL_BILL":
-                if re.search(r'\b(BILL|INVOICE|CHARGES|HOSPITAL)\b', ocr_text_upper):
-                    score += 15
-                if re.search(r'\b(CONSULTATION|PROCEDURE|ROOM CHARGES)\b', ocr_text_upper):
-                    score += 5
-
-            elif test_type == "PHARMACY_BILL":
-                if re.search(r'\b(PHARMACY|CHEMIST|MRP|BATCH|EXPIRY)\b', ocr_text_upper):
-                    score += 20
-
-            # Diagnostic Documents
-            elif test_type == "ECG_REPORT":
-                if re.search(r'\b(ECG|EKG|ELECTROCARDIOGRAM)\b', ocr_text_upper):
-                    score += 20
-
-            elif test_type == "XRAY_REPORT":
-                if re.search(r'\b(X.RAY|XRAY|RADIOGRAPH)\b', ocr_text_upper):
-                    score += 20
-
-            elif test_type == "ULTRASOUND_REPORT":
-                if re.search(r'\b(ULTRASOUND|USG|SONOGRAPHY)\b', ocr_text_upper):
-                    score += 20
-
-            # Administrative Documents
-            elif test_type == "VACCINATION_CERTIFICATE":
-                if re.search(r'\b(VACCINATION|VACCINE|IMMUNIZATION)\b', ocr_text_upper):
-                    score += 20
-
-            # Update best match
-            if score > max_score:
-                max_score = score
-                best_match = test_type
-
-        # Return best match if score is above threshold
-        if max_score >= 10:
-            return best_match
-
-        return None
+        matches = self.identify_all_test_types(ocr_text, threshold=10, top_only=True)
+        return matches[0]["test_type"] if matches else None
 
-    def identify_all_test_types(self, ocr_text: str, threshold: int = 10) -> List[Dict[str, Any]]:
+    def identify_all_test_types(self, ocr_text: str, threshold: int = 10,
+                                top_only: bool = False) -> List[Dict[str, Any]]:
         """
         Identify ALL test types present in OCR text (for multi-test documents).
 
         Returns list of dicts with test_type, score, and template info.
-        Sorted by score (highest first).
+        Sorted by score (highest first); with top_only, just the best match.
+        Results are memoized per OCR text, so repeat calls (retries, multi-stage
+        pipelines) skip the scan.
         """
+        cache_key = (hashlib.blake2b(ocr_text.encode("utf-8", "surrogatepass"), digest_size=16).digest(),
+                     threshold, top_only)
+        cached = self._identify_cache.get(cache_key)
+        if cached is None:
+            cached = self._identify_uncached(ocr_text, threshold, top_only)
+            if len(self._identify_cache) >= IDENTIFY_CACHE_SIZE:
+                self._identify_cache.clear()
+            self._identify_cache[cache_key] = cached
+
+        return [self._match_entry(template_id, score) for template_id, score in cached]
+
+    def _match_entry(self, template_id: str, score: int) -> Dict[str, Any]:
+        """identify_all_test_types result entry for a template."""
+        template = self.templates[template_id]
+        return {
+            "test_type": self._template_test_types[template_id],
+            "template_id": template.get("templateId"),
+            "display_name": template.get("displayName"),
+            "score": score,
+            "template": template
+        }
+
+    def _identify_uncached(self, ocr_text: str, threshold: int, top_only: bool) -> Tuple[Tuple[str, int], ...]:
+        """Keyword scoring behind identify_all_test_types: ranked (template ID, score) pairs."""
         ocr_text_upper = ocr_text.upper()
 
         matches = []
 
-        for template in self.templates.values():
-            score = 0
-            test_type = template.get("testType") or template.get("documentType")
-            display_name = template.get("displayName", "").upper()
-            aliases = template.get("metadata", {}).get("commonAliases", [])
-            department = template.get("department", "").upper()
+        found_keywords = self._find_keywords(ocr_text_upper)
+
+        if threshold > 0:
+            # Only templates with a keyword or rule anchor in the text can score
+            candidates = set(self._unfiltered_templates)
+            for keyword in found_keywords:
+                candidates.update(self._keyword_templates.get(keyword, ()))
+            template_ids = sorted(candidates, key=self._template_order.__getitem__)
+        else:
+            template_ids = list(self.templates)
 
-            # Check display name (strong match)
-            if display_name in ocr_text_upper:
-                score += 10
-
-            # Check aliases (strong match)
-            for alias in aliases:
-                if alias.upper() in ocr_text_upper:
-                    score += 8
-
-            # Check department (weak match)
-            if department in ocr_text_upper:
-                score += 2
-
-            # Check for specific test type keywords
-            if test_type == "COMPLETE_BLOOD_COUNT":
-                if re.search(r'\b(CBC|COMPLETE BLOOD COUNT|HEMOGRAM)\b', ocr_text_upper):
-                    score += 15
-                if re.search(r'\b(HAEMOGLOBIN|HEMOGLOBIN|WBC|RBC|PLATELET)\b', ocr_text_upper):
-                    score += 5
-
-            elif test_type == "DENGUE_PROFILE":
-                if re.search(r'\b(DENGUE|NS1|IGG|IGM)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "LIPID_PROFILE":
-                if re.search(r'\b(LIPID|CHOLESTEROL|HDL|LDL|TRIGLYCERIDE)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "LIVER_FUNCTION_TEST":
-                if re.search(r'\b(LFT|LIVER FUNCTION|SGOT|SGPT|ALT|AST|BILIRUBIN|ALKALINE PHOSPHATASE)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "KIDNEY_FUNCTION_TEST":
-                if re.search(r'\b(KFT|RFT|KIDNEY FUNCTION|RENAL FUNCTION|CREATININE|UREA|BUN)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "THYROID_FUNCTION_TEST":
-                if re.search(r'\b(TFT|THYROID|TSH|T3|T4|FT3|FT4)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "GLUCOSE_PANEL":
-                if re.search(r'\b(GLUCOSE|SUGAR|HBA1C|FASTING|POSTPRANDIAL|DIABETES)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "CRP_TEST":
-                if re.search(r'\b(CRP|C.REACTIVE PROTEIN|C REACTIVE|CREACTIVE)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "ESR_TEST":
-                if re.search(r'\b(ESR|ERYTHROCYTE SEDIMENTATION|SEDIMENTATION RATE)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "COVID19_TEST":
-                if re.search(r'\b(COVID|SARS.COV.2|CORONAVIRUS|RT.PCR|ANTIGEN)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "MALARIA_TEST":
-                if re.search(r'\b(MALARIA|PLASMODIUM|FALCIPARUM|VIVAX)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "TYPHOID_TEST":
-                if re.search(r'\b(TYPHOID|WIDAL|TYPHI|PARATYPHI)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "VITAMIN_D_TEST":
-                if re.search(r'\b(VITAMIN D|25.OH|25 HYDROXY|CHOLECALCIFEROL)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "VITAMIN_B12_TEST":
-                if re.search(r'\b(VITAMIN B12|B12|COBALAMIN|CYANOCOBALAMIN)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "IRON_STUDIES":
-                if re.search(r'\b(IRON|FERRITIN|TIBC|TRANSFERRIN|IRON BINDING)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "ELECTROLYTES_PANEL":
-                if re.search(r'\b(ELECTROLYTE|SODIUM|POTASSIUM|CHLORIDE|NA\+|K\+)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "CARDIAC_ENZYMES":
-                if re.search(r'\b(TROPONIN|CPK|CK.MB|CARDIAC|BNP|NT.PROBNP)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "URINE_ROUTINE":
-                if re.search(r'\b(URINE|URINALYSIS|MICROSCOPY|PUS CELLS)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "COAGULATION_PANEL":
-                if re.search(r'\b(COAGULATION|PT|INR|APTT|PROTHROMBIN|BLEEDING TIME)\b', ocr_text_upper):
-                    score += 15
-
-            elif test_type == "HEPATITIS_PANEL":
-                if re.search(r'\b(HEPATITIS|HBSAG|ANTI.HCV|HBV|HCV|HAV)\b', ocr_text_upper):
-                    score += 15
-
-            # Clinical Documents
-            elif test_type == "PRESCRIPTION":
-                if re.search(r'\b(PRESCRIPTION|RX|MEDICATION|DOSAGE|TABLET|CAPSULE|MEDICINE)\b', ocr_text_upper):
-                    score += 20
-                if re.search(r'\b(DOCTOR|DR\.|PHYSICIAN|CONSULTANT|MBBS|MD)\b', ocr_text_upper):
-                    score += 5
-                if re.search(r'\b(FREQUENCY|DURATION|DAYS|TIMES DAILY|BD|TDS|OD)\b', ocr_text_upper):
-                    score += 5
-
-            elif test_type == "DISCHARGE_SUMMARY":
-                if re.search(r'\b(DISCHARGE|ADMISSION|HOSPITALIZATION|INPATIENT|IPD)\b', ocr_text_upper):
-                    score += 20
-                if re.search(r'\b(ADMITTED|DISCHARGED|LENGTH OF STAY|FINAL DIAGNOSIS)\b', ocr_text_upper):
-                    score += 5
-
-            elif test_type == "MEDICAL_CERTIFICATE":
-                if re.search(r'\b(MEDICAL CERTIFICATE|SICK LEAVE|FITNESS CERTIFICATE|UNFIT|REST)\b', ocr_text_upper):
-                    score += 20
-                if re.search(r'\b(LEAVE FROM|LEAVE TO|DAYS OF LEAVE)\b', ocr_text_upper):
-                    score += 5
-
-            # Financial Documents
-            elif test_type == "HOSPITAL_BILL":
-                if re.search(r'\b(BILL|INVOICE|RECEIPT|CHARGES|CONSULTATION FEE|PAYABLE)\b', ocr_text_upper):
-                    score += 15
-                if re.search(r'\b(HOSPITAL|CLINIC|MEDICAL CENTER|HEALTH)\b', ocr_text_upper):
-                    score += 5
-                if re.search(r'\b(SUBTOTAL|TAX|GST|TOTAL AMOUNT|NET AMOUNT)\b', ocr_text_upper):
-                    score += 5
-                # Distinguish from pharmacy bill
-                if re.search(r'\b(ROOM CHARGES|CONSULTATION|PROCEDURE|SURGERY|IPD|OPD)\b', ocr_text_upper):
-                    score += 5
-
-            elif test_type == "PHARMACY_BILL":
-                if re.search(r'\b(PHARMACY|CHEMIST|MEDICAL STORE|DRUGSTORE)\b', ocr_text_upper):
-                    score += 20
-                if re.search(r'\b(MEDICINE|DRUG|TABLET|CAPSULE|SYRUP|MRP|BATCH)\b', ocr_text_upper):
-                    score += 5
-                if re.search(r'\b(EXPIRY|BATCH NO|DL NO|DRUG LICENSE)\b', ocr_text_upper):
-                    score += 5
-
-            # Diagnostic Documents
-            elif test_type == "ECG_REPORT":
-                if re.search(r'\b(ECG|EKG|ELECTROCARDIOGRAM|CARDIOGRAM)\b', ocr_text_upper):
-                    score += 20
-                if re.search(r'\b(HEART RATE|RHYTHM|PR INTERVAL|QRS|QT INTERVAL)\b', ocr_text_upper):
-                    score += 5
-
-            elif test_type == "XRAY_REPORT":
-                if re.search(r'\b(X.RAY|XRAY|RADIOGRAPH|CHEST PA|CHEST X.RAY)\b', ocr_text_upper):
-                    score += 20
-                if re.search(r'\b(FINDINGS|IMPRESSION|RADIOLOGIST|VIEW)\b', ocr_text_upper):
-                    score += 5
-
-            elif test_type == "ULTRASOUND_REPORT":
-                if re.search(r'\b(ULTRASOUND|USG|SONOGRAPHY|DOPPLER)\b', ocr_text_upper):
-                    score += 20
-                if re.search(r'\b(ABDOMEN|PELVIS|KUB|OBSTETRIC|FINDINGS|IMPRESSION)\b', ocr_text_upper):
-                    score += 5
-
-            # Administrative Documents
-            elif test_type == "VACCINATION_CERTIFICATE":
-                if re.search(r'\b(VACCINATION|VACCINE|IMMUNIZATION|DOSE|COVAXIN|COVISHIELD)\b', ocr_text_upper):
-                    score += 20
-                if re.search(r'\b(1ST DOSE|2ND DOSE|BOOSTER|BATCH NUMBER)\b', ocr_text_upper):
-                    score += 5
+        for template_id in template_ids:
+            test_type = self._template_test_types[template_id]
+
+            # Display name, aliases and department
+            score = self._keyword_score(template_id, found_keywords)
+
+            # Specific test type keywords
+            for pattern, weight in _TEST_TYPE_RULES.get(test_type, ()):
+                anchors = _RULE_ANCHORS[pattern]
+                if anchors is not None and anchors.isdisjoint(found_keywords):
+                    continue
+                if pattern.search(ocr_text_upper):
+                    score += weight
 
             # Add to matches if above threshold
             if score >= threshold:
-                matches.append({
-                    "test_type": test_type,
-                    "template_id": template.get("templateId"),
-                    "display_name": template.get("displayName"),
-                    "score": score,
-                    "template": template
-                })
+                matches.append((template_id, score))
+
+        if top_only:
+            # First template wins ties, as with the stable sort below
+            return (max(matches, key=lambda x: x[1]),) if matches else ()
 
         # Sort by score (highest first)
-        matches.sort(key=lambda x: x["score"], reverse=True)
+        matches.sort(key=lambda x: x[1], reverse=True)
 
-        return matches
+        return tuple(matches)
 
     def identify_test_type_with_llm(self, ocr_text: str, model_name: str = "qwen2.5:7b") -> Optional[str]:
         """
@@ -542,22 +578,17 @@ Your response (test type name only):"""
         param_name_upper = parameter_name.upper().strip()
 
         for param in section_params:
-            # Check direct name match
-            if param.get("displayName", "").upper() == param_name_upper:
-                return param
+            cached = self._param_names.get(id(param))
+            if cached and cached[0] is param:
+                display_name, param_id, aliases = cached[1]
+            else:
+                display_name, param_id, aliases = self._upper_names(param)
 
-            # Check parameter ID match
-            if param.get("parameterId", "").upper() == param_name_upper:
+            # Direct name, parameter ID or alias match
+            if param_name_upper == display_name or param_name_upper == param_id or param_name_upper in aliases:
                 return param
 
-            # Check aliases
-            aliases = param.get("aliases", [])
-            for alias in aliases:
-                if alias.upper() == param_name_upper:
-                    return param
-
             # Check partial matches (for OCR errors)
-            display_name = param.get("displayName", "").upper()
             if param_name_upper in display_name or display_name in param_name_upper:
                 # Calculate similarity
                 if len(param_name_upper) > 3 and len(display_name) > 3:
@@ -568,7 +599,13 @@ Your response (test type name only):"""
         return None
 
     def _calculate_similarity(self, str1: str, str2: str) -> float:
-        """Calculate simple string similarity (Jaccard similarity on words)."""
+        """
+        Calculate string similarity in [0, 1]: RapidFuzz character-level ratio
+        when installed (tolerates OCR typos), else Jaccard similarity on words.
+        """
+        if RAPIDFUZZ_AVAILABLE:
+            return fuzz.ratio(str1, str2) / 100.0
+
         words1 = set(str1.split())
         words2 = set(str2.split())
 
@@ -635,6 +672,19 @@ Your response (test type name only):"""
         # Return default range
         return ref_ranges.get("default", {})
 
+    def reference_limits(self, param: Dict) -> Tuple[Dict, Optional[float], Optional[float]]:
+        """
+        Default reference range plus critical low/high for a parameter.
+
+        Zero or missing critical values mean "no limit" (None).
+        """
+        critical = param.get("criticalValues") or {}
+        return (
+            self.get_reference_range(param),
+            critical.get("low") or None,
+            critical.get("high") or None
+        )
+
     def calculate_status(self, value: float, ref_range: Dict) -> str:
         """
         Calculate parameter status (NORMAL, HIGH, LOW) based on reference range.
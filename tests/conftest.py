@@ -0,0 +1,73 @@
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from template_manager import TemplateManager  # noqa: E402
+import template_extractor_v2  # noqa: E402
+from template_extractor_v2 import TemplateExtractorV2  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def template_manager():
+    return TemplateManager(str(REPO_ROOT / "templates"))
+
+
+@pytest.fixture
+def extractor(template_manager):
+    return TemplateExtractorV2(template_manager)
+
+
+class FakeOllama:
+    """Minimal Ollama stand-in: streams `reply` (str or callable(body) -> str) in 10-char chunks."""
+
+    def __init__(self):
+        self.reply = "{}"
+        self.requests = []
+        self.show_details = {"quantization_level": "Q4_K_M"}
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                fake.requests.append((self.path, body))
+                if self.path == "/api/show":
+                    status = 404 if body.get("model") == "missing" else 200
+                    lines = [json.dumps({"details": fake.show_details})]
+                else:
+                    status = 200
+                    text = fake.reply(body) if callable(fake.reply) else fake.reply
+                    lines = [json.dumps({"response": text[i:i + 10], "done": False})
+                             for i in range(0, len(text), 10)]
+                    lines.append(json.dumps({"response": "", "done": True}))
+                out = ("\n".join(lines) + "\n").encode()
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def fake_ollama(monkeypatch):
+    fake = FakeOllama()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), fake.handler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(template_extractor_v2, "OLLAMA_HOST", f"http://127.0.0.1:{server.server_port}")
+    yield fake
+    server.shutdown()
+    server.server_close()
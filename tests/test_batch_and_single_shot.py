@@ -0,0 +1,83 @@
+import json
+import re
+
+
+def _values(result):
+    return {p["parameterId"]: p["value"]
+            for section in result["data"]["testResults"]["sections"] for p in section["parameters"]}
+
+
+def test_batch_uses_batch_system_prompt(extractor, fake_ollama, template_manager):
+    template = template_manager.get_template_by_test_type("COMPLETE_BLOOD_COUNT")
+    fake_ollama.reply = json.dumps({"reports": [{"parameters": []}]})
+    extractor.extract_batch_prompted("qwen", ["HB 13"], template)
+    body = fake_ollama.requests[-1][1]
+    assert body["system"] == extractor._BATCH_SYSTEM
+    assert '"reports"' in body["system"]
+
+
+def test_batch_response_split_per_document(extractor, fake_ollama, template_manager):
+    template = template_manager.get_template_by_test_type("COMPLETE_BLOOD_COUNT")
+
+    def reply(body):
+        docs = re.findall(r"---DOC (\d+)---\nHB (\S+)", body["prompt"])
+        return json.dumps({"reports": [{"parameters": [{"name": "HEMOGLOBIN", "value": float(hb)}]}
+                                       for _, hb in docs]})
+    fake_ollama.reply = reply
+
+    results = extractor.extract_batch_prompted("qwen", ["HB 11", "HB 12", "HB 13"], template, batch_size=2)
+    assert [r["success"] for r in results] == [True, True, True]
+    assert [_values(r)["HEMOGLOBIN"] for r in results] == [11.0, 12.0, 13.0]
+    assert len([path for path, _ in fake_ollama.requests if path == "/api/generate"]) == 2
+
+
+def test_batch_short_reports_list_fails_missing_documents(extractor, fake_ollama, template_manager):
+    template = template_manager.get_template_by_test_type("COMPLETE_BLOOD_COUNT")
+    fake_ollama.reply = json.dumps({"reports": [{"parameters": [{"name": "HEMOGLOBIN", "value": 14}]}]})
+    results = extractor.extract_batch_prompted("qwen", ["HB 14", "HB 15"], template)
+    assert results[0]["success"] and not results[1]["success"]
+
+
+def test_batch_without_envelope_fails_every_document(extractor, fake_ollama, template_manager):
+    template = template_manager.get_template_by_test_type("COMPLETE_BLOOD_COUNT")
+    fake_ollama.reply = json.dumps({"parameters": []})
+    results = extractor.extract_batch_prompted("qwen", ["HB 14", "HB 15"], template)
+    assert [r["error"] for r in results] == ["Stage 1 JSON parsing failed"] * 2
+
+
+def test_single_shot_splits_keyed_parameters(extractor, fake_ollama, template_manager):
+    template = template_manager.get_template_by_test_type("LIVER_FUNCTION_TEST")
+    fake_ollama.reply = json.dumps({
+        "metadata": {"patientName": "A"},
+        "parameters": {"TOTAL_PROTEIN": {"value": 7.0, "unit": "g/dL"}, "ALBUMIN": 4.0, "NOT_IN_TEMPLATE": 1},
+    })
+    result = extractor.extract_single_shot("qwen", "Total protein 7.0 Albumin 4.0", template)
+    body = fake_ollama.requests[-1][1]
+    assert body["system"] == extractor._SINGLE_SHOT_SYSTEM
+    assert result["success"]
+    assert result["data"]["documentMetadata"] == {"patientName": "A"}
+    values = _values(result)
+    assert values["TOTAL_PROTEIN"] == 7.0 and values["ALBUMIN"] == 4.0
+    assert values["GLOBULIN"] == 3.0  # formulas still run on keyed output
+    assert "NOT_IN_TEMPLATE" not in values
+
+
+def test_single_shot_rejects_list_shaped_parameters(extractor, fake_ollama, template_manager):
+    template = template_manager.get_template_by_test_type("LIVER_FUNCTION_TEST")
+    fake_ollama.reply = json.dumps({"parameters": [{"name": "ALBUMIN", "value": 4.0}]})
+    result = extractor.extract_single_shot("qwen", "Albumin 4.0", template)
+    assert not result["success"] and result["stage"] == 1
+
+
+def test_single_shot_rejects_top_level_array(extractor, fake_ollama, template_manager):
+    template = template_manager.get_template_by_test_type("LIVER_FUNCTION_TEST")
+    fake_ollama.reply = json.dumps([{"name": "ALBUMIN", "value": 4.0}])
+    result = extractor.extract_with_llm("qwen", "Albumin 4.0", template, mode="single_shot")
+    assert not result["success"] and result["error"] == "Single-shot JSON parsing failed"
+
+
+def test_extract_with_llm_single_shot_mode_delegates(extractor, fake_ollama, template_manager):
+    template = template_manager.get_template_by_test_type("LIVER_FUNCTION_TEST")
+    fake_ollama.reply = json.dumps({"parameters": {"ALBUMIN": 4.0}})
+    result = extractor.extract_with_llm("qwen", "Albumin 4.0", template, mode="single_shot")
+    assert result["success"] and _values(result)["ALBUMIN"] == 4.0
@@ -0,0 +1,70 @@
+from template_extractor_v2 import TemplateExtractorV2, _compress_ocr
+
+LIPID_TWO_PAGES = """=== Page 1 ===
+CITY DIAGNOSTIC LABORATORY
+Patient: John Doe
+LIPID PROFILE
+Total Cholesterol
+180
+mg/dL
+HDL Cholesterol
+45
+mg/dL
+40-60
+Negative
+This report is electronically generated
+=== Page 2 ===
+CITY DIAGNOSTIC LABORATORY
+LDL Cholesterol
+100
+mg/dL
+Triglycerides
+150
+mg/dL
+Negative
+This report is electronically generated"""
+
+
+def test_unchanged_by_default():
+    assert _compress_ocr(LIPID_TWO_PAGES) == LIPID_TWO_PAGES
+
+
+def test_repeated_unit_and_value_lines_survive_dedupe():
+    lines = _compress_ocr(LIPID_TWO_PAGES, dedupe_pages=True).split("\n")
+    assert lines.count("mg/dL") == 4
+    assert lines.count("Negative") == 2
+
+
+def test_header_and_footer_kept_on_first_page_only():
+    lines = _compress_ocr(LIPID_TWO_PAGES, dedupe_pages=True).split("\n")
+    assert lines.count("CITY DIAGNOSTIC LABORATORY") == 1
+    assert lines.count("This report is electronically generated") == 1
+    assert lines.index("CITY DIAGNOSTIC LABORATORY") < lines.index("=== Page 2 ===")
+
+
+def test_repeated_line_inside_page_body_is_kept():
+    body = "Comment: sample haemolysed slightly"
+    text = "\n".join([
+        "=== Page 1 ===", "Header A", "x 1", "y 2", body, "z 3", "w 4", "v 5", "Footer",
+        "=== Page 2 ===", "Header B", "x 1", "y 2", body, "z 3", "w 4", "v 5", "Footer",
+    ])
+    assert _compress_ocr(text, dedupe_pages=True).count(body) == 2
+
+
+def test_single_page_untouched():
+    text = "CITY DIAGNOSTIC LABORATORY\nHDL\n45\nCITY DIAGNOSTIC LABORATORY"
+    assert _compress_ocr(text, dedupe_pages=True) == text
+
+
+def test_max_chars_drops_digit_free_lines_first():
+    text = "HDL 45\nsome long disclaimer text here\nLDL 100"
+    result = _compress_ocr(text, max_chars=16)
+    assert "HDL 45" in result and "LDL 100" in result
+    assert "disclaimer" not in result
+
+
+def test_freeform_prompt_keeps_units(extractor, template_manager):
+    template = template_manager.get_template_by_test_type("LIPID_PROFILE")
+    prompt = extractor._get_freeform_prompt(LIPID_TWO_PAGES, template)
+    assert prompt.count("mg/dL") >= 4
+    assert not TemplateExtractorV2.DEDUPE_OCR_PAGES
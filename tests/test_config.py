@@ -0,0 +1,24 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import REPO_ROOT
+
+
+def _num_parallel(value):
+    env = dict(os.environ, OLLAMA_NUM_PARALLEL=value)
+    out = subprocess.run([sys.executable, "-c", "import template_extractor_v2 as m; print(m.OLLAMA_NUM_PARALLEL)"],
+                         cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True)
+    return out.stdout.strip().splitlines()
+
+
+@pytest.mark.parametrize("value, expected", [("8", "8"), ("0", "1"), ("abc", "4"), ("", "4")])
+def test_num_parallel_env(value, expected):
+    assert _num_parallel(value)[-1] == expected
+
+
+
+def test_import_has_no_stdout_side_effect():
+    assert _num_parallel("") == ["4"]
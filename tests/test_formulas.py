@@ -0,0 +1,63 @@
+import pytest
+
+from template_manager import compile_formula
+
+
+def _values(mapped):
+    return {p["parameterId"]: p["value"]
+            for section in mapped["testResults"]["sections"] for p in section["parameters"]}
+
+
+def test_compile_formula_returns_dependencies():
+    code, deps = compile_formula("TOTAL_CHOLESTEROL - HDL_CHOLESTEROL - (TRIGLYCERIDES / 5)")
+    assert deps == {"TOTAL_CHOLESTEROL", "HDL_CHOLESTEROL", "TRIGLYCERIDES"}
+    assert eval(code, {"__builtins__": {}}, {"TOTAL_CHOLESTEROL": 200, "HDL_CHOLESTEROL": 50,
+                                             "TRIGLYCERIDES": 150}) == 120
+
+
+@pytest.mark.parametrize("formula", [
+    "__import__('os').system('true')",
+    "HEMOGLOBIN.__class__",
+    "(lambda: 1)()",
+    "[x for x in range(3)]",
+    "PCV if PCV else 0",
+    "PCV / ",
+])
+def test_compile_formula_rejects_non_arithmetic(formula):
+    assert compile_formula(formula) is None
+
+
+@pytest.mark.parametrize("test_type, order", [
+    ("LIVER_FUNCTION_TEST", ["GLOBULIN", "AG_RATIO"]),
+    ("KIDNEY_FUNCTION_TEST", ["BUN", "BUN_CREATININE_RATIO"]),
+    ("COMPLETE_BLOOD_COUNT", ["NEUTROPHILS_ABSOLUTE", "NLR"]),
+])
+def test_formula_order_puts_dependencies_first(template_manager, test_type, order):
+    template = template_manager.get_template_by_test_type(test_type)
+    ids = [param_id for param_id, *_ in template_manager.compile_template(template).formula_order]
+    assert ids.index(order[0]) < ids.index(order[1])
+
+
+@pytest.mark.parametrize("test_type, extracted, expected", [
+    ("LIVER_FUNCTION_TEST", {"TOTAL_PROTEIN": 7.0, "ALBUMIN": 4.0},
+     {"GLOBULIN": 3.0, "AG_RATIO": 1.33}),
+    ("KIDNEY_FUNCTION_TEST", {"BLOOD_UREA": 42.8, "SERUM_CREATININE": 1.0},
+     {"BUN": 20.0, "BUN_CREATININE_RATIO": 20.0}),
+    ("COMPLETE_BLOOD_COUNT", {"WBC_COUNT": 8000, "NEUTROPHILS_PERCENT": 60, "LYMPHOCYTES_PERCENT": 30},
+     {"NEUTROPHILS_ABSOLUTE": 4800, "LYMPHOCYTES_ABSOLUTE": 2400, "NLR": 2.0}),
+])
+def test_chained_formulas_filled_in_one_pass(extractor, template_manager, test_type, extracted, expected):
+    template = template_manager.get_template_by_test_type(test_type)
+    freeform = {"parameters": [{"name": name, "value": value} for name, value in extracted.items()]}
+    values = _values(extractor._map_to_template(freeform, template))
+    for param_id, value in expected.items():
+        assert values[param_id] == pytest.approx(value, abs=0.01)
+
+
+def test_extracted_value_is_not_overwritten_by_formula(extractor, template_manager):
+    template = template_manager.get_template_by_test_type("LIVER_FUNCTION_TEST")
+    freeform = {"parameters": [{"name": "TOTAL_PROTEIN", "value": 7.0}, {"name": "ALBUMIN", "value": 4.0},
+                               {"name": "GLOBULIN", "value": 2.5}]}
+    values = _values(extractor._map_to_template(freeform, template))
+    assert values["GLOBULIN"] == 2.5
+    assert values["AG_RATIO"] == pytest.approx(1.6)
@@ -0,0 +1,85 @@
+import pytest
+
+SAMPLES = [
+    "COMPLETE BLOOD COUNT (CBC)\nHAEMOGLOBIN 13.5\nPCV 40\nRBC COUNT 4.5",
+    "LIPID PROFILE\nTOTAL CHOLESTEROL 180\nHDL CHOLESTEROL 45",
+    "Dengue NS1 antigen: Positive",
+    "HOSPITAL BILL / INVOICE Consultation Fee Room Charges TOTAL AMOUNT GST",
+    "Na+ 140 K+ 4.1 chloride electrolyte",
+    "c-reactive protein 5 mg/L  sars-cov-2 rt-pcr negative x-ray chest pa",
+    "PRESCRIPTION Dr. Sarah MBBS tablet 1-0-1 for 7 days BD",
+    "nothing relevant here at all",
+    "",
+]
+
+
+def _ranked(matches):
+    return [(m["test_type"], m["score"]) for m in matches]
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+@pytest.mark.parametrize("threshold", [1, 10, 20])
+def test_candidate_prefilter_matches_full_scan(template_manager, text, threshold):
+    # threshold <= 0 scores every template, so it is the unfiltered reference
+    full = [m for m in _ranked(template_manager.identify_all_test_types(text, threshold=0))
+            if m[1] >= threshold]
+    assert _ranked(template_manager.identify_all_test_types(text, threshold=threshold)) == full
+
+
+def test_zero_threshold_returns_every_template(template_manager):
+    assert len(template_manager.identify_all_test_types("", threshold=0)) == len(template_manager.templates)
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_identify_test_type_is_top_match(template_manager, text):
+    matches = template_manager.identify_all_test_types(text)
+    assert template_manager.identify_test_type(text) == (matches[0]["test_type"] if matches else None)
+
+
+def test_blood_count_identified(template_manager):
+    assert template_manager.identify_test_type(SAMPLES[0]) == "COMPLETE_BLOOD_COUNT"
+
+
+@pytest.fixture
+def fresh_manager(template_manager):
+    from template_manager import TemplateManager
+    return TemplateManager(str(template_manager.templates_dir))
+
+
+def test_repeat_calls_hit_the_memo(fresh_manager, monkeypatch):
+    first = fresh_manager.identify_all_test_types(SAMPLES[0])
+
+    def fail(*args):
+        raise AssertionError("scored again")
+    monkeypatch.setattr(fresh_manager, "_identify_uncached", fail)
+    assert fresh_manager.identify_all_test_types(SAMPLES[0]) == first
+
+
+def test_memo_returns_fresh_dicts(fresh_manager):
+    first = fresh_manager.identify_all_test_types(SAMPLES[0])
+    first[0]["score"] = -1
+    first.clear()
+    again = fresh_manager.identify_all_test_types(SAMPLES[0])
+    assert again and again[0]["score"] > 0
+
+
+def test_memo_keyed_by_threshold_and_top_only(fresh_manager):
+    text = SAMPLES[5]
+    assert len(fresh_manager.identify_all_test_types(text, threshold=0)) == len(fresh_manager.templates)
+    assert len(fresh_manager.identify_all_test_types(text, threshold=0, top_only=True)) == 1
+    assert len(fresh_manager.identify_all_test_types(text)) < len(fresh_manager.templates)
+
+
+def test_memo_cleared_when_templates_reindexed(fresh_manager):
+    fresh_manager.identify_all_test_types(SAMPLES[0])
+    assert fresh_manager._identify_cache
+    fresh_manager._load_all_templates()
+    assert not fresh_manager._identify_cache
+
+
+def test_memo_is_bounded(fresh_manager, monkeypatch):
+    import template_manager
+    monkeypatch.setattr(template_manager, "IDENTIFY_CACHE_SIZE", 3)
+    for i in range(10):
+        fresh_manager.identify_all_test_types(f"CBC {i}")
+    assert len(fresh_manager._identify_cache) <= 3
@@ -0,0 +1,87 @@
+import pytest
+import requests
+from urllib3.exceptions import ReadTimeoutError
+
+from template_extractor_v2 import _JsonEndDetector
+
+
+def _feed_all(chunks):
+    detector = _JsonEndDetector()
+    for i, chunk in enumerate(chunks):
+        if detector.feed(chunk):
+            return i
+    return None
+
+
+def test_detects_end_of_object_across_chunks():
+    assert _feed_all(['{"a": [1, ', '2]', '}', ' trailing']) == 2
+
+
+def test_ignores_braces_inside_strings():
+    assert _feed_all(['{"note": "x } y { z"', ', "b": "\\"}"', '}']) == 2
+
+
+def test_escaped_backslash_before_quote_closes_string():
+    assert _feed_all(['{"path": "C:\\\\"', '}']) == 1
+
+
+def test_incomplete_object_never_finishes():
+    assert _feed_all(['{"a": {"b": 1}', ' ']) is None
+
+
+def test_leading_text_before_object_is_ignored():
+    assert _feed_all(['Here you go: ', '{"a": 1}']) == 1
+
+
+def test_call_llm_stops_after_json_object(extractor, fake_ollama):
+    fake_ollama.reply = '{"parameters": [{"name": "HB", "value": "13 }"}]}' + " and some commentary" * 5
+    text, _, error = extractor._call_llm("qwen", "prompt")
+    assert error is None
+    assert text.rstrip().endswith("]}")
+    assert "commentary" not in text
+
+
+def test_call_llm_sends_json_mode_payload(extractor, fake_ollama):
+    fake_ollama.reply = "{}"
+    extractor._call_llm("qwen", "prompt")
+    path, body = fake_ollama.requests[-1]
+    assert path == "/api/generate"
+    assert body["format"] == "json" and body["stream"] is True
+    assert body["system"] == extractor._STATIC_SYSTEM
+
+
+
+@pytest.mark.parametrize("error, attempts", [
+    (requests.exceptions.ConnectionError("Connection refused"), 1),
+    (requests.exceptions.ConnectionError(ReadTimeoutError(None, None, "Read timed out.")), 3),
+    (requests.exceptions.ReadTimeout("Read timed out."), 3),
+])
+def test_call_llm_retries_only_timeouts(template_manager, monkeypatch, error, attempts):
+    import template_extractor_v2
+    calls = []
+
+    def fake_post(*args, **kwargs):
+        calls.append(kwargs["timeout"])
+        raise error
+    monkeypatch.setattr(template_extractor_v2._session(), "post", fake_post)
+    monkeypatch.setattr(template_extractor_v2.time, "sleep", lambda _: None)
+    extractor = template_extractor_v2.TemplateExtractorV2(template_manager, max_retries=2)
+    text, _, message = extractor._call_llm("qwen", "prompt")
+    assert text == "" and message and len(calls) == attempts
+
+def test_each_thread_gets_its_own_session():
+    import threading
+    import template_extractor_v2
+    from concurrent.futures import ThreadPoolExecutor
+
+    barrier = threading.Barrier(3)
+
+    def worker(_):
+        barrier.wait()
+        return template_extractor_v2._session()
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        sessions = list(pool.map(worker, range(3)))
+    main = template_extractor_v2._session()
+    assert main is template_extractor_v2._session()
+    assert len({id(s) for s in sessions + [main]}) == 4
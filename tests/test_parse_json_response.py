@@ -0,0 +1,43 @@
+import pytest
+
+import template_extractor_v2
+
+
+@pytest.fixture(params=[True, False], ids=["json_repair", "regex_fallback"])
+def parse(request, extractor, monkeypatch):
+    if request.param and not template_extractor_v2.JSON_REPAIR_AVAILABLE:
+        pytest.skip("json_repair not installed")
+    monkeypatch.setattr(template_extractor_v2, "JSON_REPAIR_AVAILABLE", request.param)
+    return extractor._parse_json_response
+
+
+def test_well_formed_json(parse):
+    assert parse('{"parameters": [{"name": "HB", "value": 13.5}]}') == {
+        "parameters": [{"name": "HB", "value": 13.5}]}
+
+
+@pytest.mark.parametrize("response", [
+    '```json\n{"a": 1}\n```',
+    '```\n{"a": 1}```',
+    '  {"a": 1}  ',
+])
+def test_markdown_fences_and_whitespace(parse, response):
+    assert parse(response) == {"a": 1}
+
+
+def test_bare_keys_are_quoted(parse):
+    assert parse('{a: 1, b: "x"}') == {"a": 1, "b": "x"}
+
+
+def test_colons_inside_values_are_preserved(parse):
+    assert parse('{time: "10:30", ratio: "1:2"}') == {"time": "10:30", "ratio": "1:2"}
+
+
+def test_garbage_returns_none(parse):
+    assert parse("garbage") is None
+
+
+def test_trailing_comma_repaired_when_json_repair_installed(extractor):
+    if not template_extractor_v2.JSON_REPAIR_AVAILABLE:
+        pytest.skip("json_repair not installed")
+    assert extractor._parse_json_response('{"a": 1, "b": [1, 2,],}') == {"a": 1, "b": [1, 2]}
@@ -0,0 +1,29 @@
+import pytest
+
+import template_extractor_v2
+
+
+@pytest.mark.parametrize("details, expected", [
+    ({"quantization_level": "Q4_K_M"}, True),
+    ({"quantization_level": "F16"}, False),
+    ({"family": "qwen2"}, False),
+])
+def test_quantization_level(extractor, fake_ollama, details, expected):
+    fake_ollama.show_details = details
+    assert extractor.validate_model("qwen2.5:7b") is expected
+    assert fake_ollama.requests[-1] == ("/api/show", {"model": "qwen2.5:7b"})
+
+
+def test_missing_model(extractor, fake_ollama):
+    assert extractor.validate_model("missing") is False
+
+
+def test_probe_uses_short_timeout(extractor, monkeypatch):
+    seen = {}
+
+    def fake_post(url, json, timeout):
+        seen["timeout"] = timeout
+        raise template_extractor_v2.requests.exceptions.ConnectTimeout("slow")
+    monkeypatch.setattr(template_extractor_v2._session(), "post", fake_post)
+    assert extractor.validate_model("qwen2.5:7b") is False
+    assert seen["timeout"] == template_extractor_v2.MODEL_PROBE_TIMEOUT < extractor.request_timeout